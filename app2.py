@@ -1,10 +1,20 @@
 # streamlit_app.py
+import hashlib
+import io
 import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterable
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import pyarrow.parquet as pq
 import streamlit as st
 from apify_client import ApifyClient
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ---------- Config de página ----------
 st.set_page_config(page_title="Twitter Scraper · Respuestas y Citas", page_icon="📊", layout="wide")
@@ -34,148 +44,516 @@ def _ensure_cols(df: pd.DataFrame, cols: list[str]) -> pd.DataFrame:
         return df
     return df[[c for c in cols if c in df.columns]]
 
-_TWEET_ID_PATTERNS = [
-    re.compile(r"https?://(?:www\.)?(?:x|twitter)\.com/[^/]+/status/(\d+)", re.I),
-    re.compile(r"https?://(?:www\.)?(?:x|twitter)\.com/i/(?:web/)?status/(\d+)", re.I),
-]
+NUM_COLS = ("viewCount","likeCount","replyCount","retweetCount","quoteCount","bookmarkCount","author/followers")
+
+# Texto en buffers Arrow contiguos en lugar de un objeto str por fila
+STR_COLS = ["id", "text", "url", "author/profilePicture"]
+
+TIPOS = ["reply", "quote"]
+
+# column_config construidos una sola vez (Streamlit re-ejecuta el script en cada interacción)
+PREVIEW_COLUMN_CONFIG = {
+    "author/profilePicture": st.column_config.ImageColumn("Foto"),
+    "url": st.column_config.LinkColumn("Tweet"),
+    "author/userName": st.column_config.TextColumn("Usuario"),
+    "text": st.column_config.TextColumn("Contenido"),
+}
+TOP10_COLUMN_CONFIG = {
+    "author/profilePicture": st.column_config.ImageColumn("Foto"),
+    "url": st.column_config.LinkColumn("URL"),
+    "viewCount": st.column_config.NumberColumn("Vistas", format="%d"),
+    "createdAt": st.column_config.DatetimeColumn("Fecha"),
+    "author/userName": st.column_config.TextColumn("Usuario"),
+    "author/followers": st.column_config.NumberColumn("Seguidores", format="%d"),
+    "likeCount": st.column_config.NumberColumn("Likes", format="%d"),
+    "replyCount": st.column_config.NumberColumn("Respuestas", format="%d"),
+    "retweetCount": st.column_config.NumberColumn("Retweets", format="%d"),
+    "quoteCount": st.column_config.NumberColumn("Citas", format="%d"),
+    "bookmarkCount": st.column_config.NumberColumn("Guardados", format="%d"),
+    "text": st.column_config.TextColumn("Contenido"),
+    "sentimiento": st.column_config.TextColumn("Sentimiento"),
+    "tipo": st.column_config.TextColumn("Tipo"),
+}
+TOP_USERS_COLUMN_CONFIG = {
+    "author/profilePicture": st.column_config.ImageColumn("Foto"),
+    "author/userName": st.column_config.TextColumn("Usuario"),
+    "author/followers": st.column_config.NumberColumn("Seguidores", format="%d"),
+}
+
+AUTHOR_FIELDS = ["profilePicture", "followers", "userName"]
+AUTHOR_COLS = [f"author/{f}" for f in AUTHOR_FIELDS]
+_AUTHOR_FIELD_COLS = tuple(zip(AUTHOR_FIELDS, AUTHOR_COLS))
+
+TWEET_FIELDS = ["text","createdAt","url","likeCount","replyCount","retweetCount","quoteCount","bookmarkCount","viewCount","id"]
+# Proyección del lado de Apify: menos bytes que bajar y decodificar como JSON
+APIFY_FIELDS = TWEET_FIELDS + ["author"]
+TWEET_COLS = ["author/profilePicture","text","createdAt","author/userName","author/followers",
+              "url","likeCount","replyCount","retweetCount","quoteCount","bookmarkCount","viewCount","id"]
+
+# Columnas que realmente se muestran (el resto no viaja al navegador), en el orden del frame
+_FRAME_COLS = TWEET_COLS + ["tipo", "sentimiento"]
+PREVIEW_COLS = [c for c in _FRAME_COLS if c in PREVIEW_COLUMN_CONFIG]
+TOP10_COLS = [c for c in _FRAME_COLS if c in TOP10_COLUMN_CONFIG]
+
+def _items_to_frame(items: Iterable[dict]) -> pd.DataFrame:
+    """Arma el DataFrame columna a columna en una sola pasada, solo con los campos que usamos."""
+    buf = {c: [] for c in TWEET_COLS}
+    for it in items:
+        for c in TWEET_FIELDS:
+            buf[c].append(it.get(c))
+        a = it.get("author")
+        a = a if isinstance(a, dict) else {}
+        for f, c in _AUTHOR_FIELD_COLS:
+            buf[c].append(a.get(f))
+    # Sin items: frame sin columnas (como antes), para no degradar los dtypes en el concat
+    if not buf["id"]:
+        return pd.DataFrame()
+    return pd.DataFrame(buf, columns=TWEET_COLS)
+
+_TWEET_ID_RX = re.compile(
+    r"https?://(?:www\.)?(?:x|twitter)\.com/(?:i/(?:web/)?status|[^/]+/status)/(?P<id>\d+)", re.I
+)
+
+# Solo dígitos ASCII (str.isdigit también acepta dígitos Unicode)
+_DIGITS_RX = re.compile(r"\d+", re.ASCII)
+
+def _is_tweet_id(value) -> bool:
+    return isinstance(value, str) and _DIGITS_RX.fullmatch(value) is not None
 
+@lru_cache(maxsize=256)
 def extract_tweet_id_from_url(value: str | None) -> str | None:
     if not value:
         return None
     s = value.strip()
-    if s.isdigit():
+    if _DIGITS_RX.fullmatch(s):
         return s
-    for rx in _TWEET_ID_PATTERNS:
-        m = rx.search(s)
-        if m:
-            return m.group(1)
-    return None
+    m = _TWEET_ID_RX.search(s)
+    return m.group("id") if m else None
+
+def _limpiar_tweets(df: pd.DataFrame, tweet_id: str) -> pd.DataFrame:
+    """Excluye el tweet original y duplicados con una sola máscara."""
+    if df.empty:
+        return df
+    ids = df["id"]
+    # Duplicados por id (clave natural, más barata de hashear); por URL si faltan ids
+    dedup_col = "id" if ids.notna().all() else "url"
+    mask = ids.ne(str(tweet_id)).fillna(True) & ~df[dedup_col].duplicated()
+    return df.loc[mask.to_numpy(dtype=bool)]
 
 # Evita UnhashableParamError: cacheamos el CLIENT como recurso, data por separado
 @st.cache_resource(show_spinner=False)
 def get_apify_client(token: str) -> ApifyClient:
     return ApifyClient(token)
 
-# ===================== Scrapers (cacheados por tweet_id + token) =====================
-@st.cache_data(ttl=3600, show_spinner=False)
+REPLIES_ACTOR = "kaitoeasyapi/twitter-reply"
+QUOTES_ACTOR = "kaitoeasyapi/twitter-x-data-tweet-scraper-pay-per-result-cheapest"
+MAX_ITEMS = 3000
+
+# ===================== Scrapers (cacheados por tweet_id; el token no entra en la clave) =====================
+def _freeze_input(run_input: dict) -> tuple:
+    """Clave estable para el input de un actor (independiente del orden de las claves)."""
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in run_input.items()))
+
+# Sin caché propia: solo la llama _scrape_parquet, que ya cachea el resultado compacto
+def _run_actor(actor_id: str, run_input: tuple, token: str) -> pd.DataFrame:
+    """Corre un actor de Apify y devuelve sus items en columnas."""
+    client = get_apify_client(token)
+    run = client.actor(actor_id).call(run_input={k: list(v) if isinstance(v, tuple) else v for k, v in run_input})
+    # iterate_items pagina por debajo: los items se vuelcan a columnas sin juntar toda la lista cruda
+    return _items_to_frame(client.dataset(run["defaultDatasetId"]).iterate_items(fields=APIFY_FIELDS, clean=True))
+
+def _postprocess_tweets(df: pd.DataFrame, tipo: str) -> pd.DataFrame:
+    """Columnas crudas de Apify -> DataFrame tipado con lo que usa la app."""
+    if df.empty:
+        return df
+
+    # Numéricos y fechas
+    num_cols = list(NUM_COLS)
+    # Apify suele mandar números JSON: solo se coerciona lo que no llegó numérico
+    a_convertir = [c for c in num_cols if not pd.api.types.is_numeric_dtype(df[c])]
+    if a_convertir:
+        df[a_convertir] = df[a_convertir].apply(pd.to_numeric, errors="coerce")
+    # Recorte antes del cast: un valor fuera de rango no debe envolver a un conteo negativo
+    df[num_cols] = df[num_cols].fillna(0).clip(0, np.iinfo("int32").max).astype("int32")
+    df["createdAt"] = pd.to_datetime(df["createdAt"], errors="coerce", utc=True)
+    df[STR_COLS] = df[STR_COLS].astype("string[pyarrow]")
+    # Usuarios frecuentes se repiten: categoría en vez de un string por fila
+    df["author/userName"] = df["author/userName"].astype("category")
+
+    df["tipo"] = pd.Categorical([tipo] * len(df), categories=TIPOS)
+    return df
+
+# Cache en disco: sobrevive a reinicios del proceso (st.cache_data es solo en memoria)
+DISK_CACHE_DIR = os.getenv("DISK_CACHE_DIR", ".cache")
+DISK_CACHE_TTL = 3600
+# Menor que DISK_CACHE_TTL: un dato leído de disco no pasa más de DISK_CACHE_TTL en total entre disco y memoria
+SCRAPE_CACHE_TTL = 900
+
+def _disk_cache_path(actor_id: str, run_input: tuple, tweet_id: str) -> str:
+    # El input del actor entra en el nombre: cambiar MAX_ITEMS (u otro parámetro) no sirve un archivo viejo
+    input_hash = hashlib.sha1(repr(run_input).encode("utf-8")).hexdigest()[:10]
+    return os.path.join(DISK_CACHE_DIR, actor_id.replace("/", "__"), f"{tweet_id}-{input_hash}.parquet")
+
+def _disk_cache_get(path: str) -> bytes | None:
+    try:
+        if not os.path.exists(path):
+            return None
+        edad = time.time() - os.path.getmtime(path)
+        if edad >= DISK_CACHE_TTL:
+            os.remove(path)
+            return None
+        # Debe quedarle vida para todo el TTL en memoria; si no, se vuelve a scrapear
+        if edad >= DISK_CACHE_TTL - SCRAPE_CACHE_TTL:
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        # Un archivo truncado o corrupto no debe quedar en st.cache_data: se valida el footer
+        pq.read_metadata(io.BytesIO(data))
+        return data
+    except Exception:
+        pass
+    return None
+
+def _disk_cache_barrer(directorio: str):
+    """Borra los .parquet/.tmp vencidos del directorio (tweets que nadie vuelve a pedir, inputs viejos)."""
+    limite = time.time() - DISK_CACHE_TTL
+    try:
+        with os.scandir(directorio) as it:
+            for e in it:
+                if e.name.endswith((".parquet", ".tmp")) and e.stat().st_mtime < limite:
+                    try:
+                        os.remove(e.path)
+                    except OSError:
+                        pass
+    except OSError:
+        pass
+
+def _disk_cache_put(data: bytes, path: str):
+    directorio = os.path.dirname(path)
+    # Escritura atómica: un lector nunca ve un archivo a medio escribir
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(directorio, exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+    _disk_cache_barrer(directorio)
+
+# Se cachea el Parquet serializado: un blob de bytes compacto, que es además lo que va a disco
+@st.cache_data(ttl=SCRAPE_CACHE_TTL, show_spinner=False)
+def _scrape_parquet(actor_id: str, run_input: tuple, tipo: str, _token: str, tweet_id: str) -> bytes:
+    path = _disk_cache_path(actor_id, run_input, tweet_id)
+    data = _disk_cache_get(path)
+    if data is not None:
+        return data
+    df = _postprocess_tweets(_run_actor(actor_id, run_input, _token), tipo)
+    df = _limpiar_tweets(df, tweet_id)
+    buf = io.BytesIO()
+    df.to_parquet(buf, compression="zstd")
+    data = buf.getvalue()
+    if not df.empty:
+        _disk_cache_put(data, path)
+    return data
+
+def _leer_parquet(data: bytes) -> pd.DataFrame:
+    """Parquet cacheado -> DataFrame, restaurando string[pyarrow] (la lectura lo devuelve como string[python])."""
+    df = pd.read_parquet(io.BytesIO(data))
+    str_cols = [c for c in STR_COLS if c in df.columns]
+    if str_cols:
+        df[str_cols] = df[str_cols].astype("string[pyarrow]")
+    return df
+
 def get_replies(tweet_id: str, token: str) -> pd.DataFrame:
     """Obtiene replies del hilo (conversation_id=tweet_id)."""
-    try:
-        if not (isinstance(tweet_id, str) and tweet_id.isdigit()):
-            return pd.DataFrame()
-        client = get_apify_client(token)
-        run = client.actor("kaitoeasyapi/twitter-reply").call(run_input={
-            "conversation_ids": [tweet_id],
-            "maxItems": 3000
-        })
-        items = client.dataset(run["defaultDatasetId"]).list_items().items or []
-        df = pd.DataFrame(items)
-        if df.empty:
-            return df
-
-        # Derivados del autor
-        if "author" in df.columns:
-            df["author/profilePicture"] = df["author"].apply(lambda x: x.get("profilePicture") if isinstance(x, dict) else None)
-            df["author/followers"] = df["author"].apply(lambda x: x.get("followers") if isinstance(x, dict) else None)
-            df["author/userName"] = df["author"].apply(lambda x: x.get("userName") if isinstance(x, dict) else None)
-
-        # Numéricos y fechas
-        for c in ["viewCount","likeCount","replyCount","retweetCount","quoteCount","bookmarkCount","author/followers"]:
-            if c in df.columns:
-                df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
-        if "createdAt" in df.columns:
-            df["createdAt"] = pd.to_datetime(df["createdAt"], errors="coerce", utc=True)
-
-        cols = ["author/profilePicture","text","createdAt","author/userName","author/followers",
-                "url","likeCount","replyCount","retweetCount","quoteCount","bookmarkCount","viewCount","id"]
-        df = _ensure_cols(df, cols)
-        df["tipo"] = "reply"
-        return df
-    except Exception as e:
-        st.error(f"Error al obtener respuestas: {e}")
+    if not _is_tweet_id(tweet_id):
         return pd.DataFrame()
+    return _leer_parquet(_scrape_parquet(REPLIES_ACTOR, _freeze_input({
+        "conversation_ids": [tweet_id],
+        "maxItems": MAX_ITEMS
+    }), "reply", token, tweet_id))
 
-@st.cache_data(ttl=3600, show_spinner=False)
 def get_quotes(tweet_id: str, token: str) -> pd.DataFrame:
     """Obtiene quote tweets que citan el tweet_id."""
+    if not _is_tweet_id(tweet_id):
+        return pd.DataFrame()
+    return _leer_parquet(_scrape_parquet(QUOTES_ACTOR, _freeze_input({
+        "filter:quote": True,
+        "quoted_tweet_id": tweet_id,
+        "maxItems": MAX_ITEMS
+    }), "quote", token, tweet_id))
+
+# Los errores salen de la función cacheada (no quedan en caché) y se muestran desde el hilo principal
+def _descargar(scraper, tweet_id: str, token: str) -> tuple[pd.DataFrame, str | None]:
+    """Corre un scraper y devuelve (df, error) sin llamar a la UI de Streamlit."""
     try:
-        if not (isinstance(tweet_id, str) and tweet_id.isdigit()):
-            return pd.DataFrame()
-        client = get_apify_client(token)
-        run = client.actor("kaitoeasyapi/twitter-x-data-tweet-scraper-pay-per-result-cheapest").call(run_input={
-            "filter:quote": True,
-            "quoted_tweet_id": str(tweet_id),
-            "maxItems": 3000
-        })
-        items = client.dataset(run["defaultDatasetId"]).list_items().items or []
-        df = pd.DataFrame(items)
-        if df.empty:
-            return df
-
-        if "author" in df.columns:
-            df["author/profilePicture"] = df["author"].apply(lambda x: x.get("profilePicture") if isinstance(x, dict) else None)
-            df["author/followers"] = df["author"].apply(lambda x: x.get("followers") if isinstance(x, dict) else None)
-            df["author/userName"] = df["author"].apply(lambda x: x.get("userName") if isinstance(x, dict) else None)
-
-        for c in ["viewCount","likeCount","replyCount","retweetCount","quoteCount","bookmarkCount","author/followers"]:
-            if c in df.columns:
-                df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
-        if "createdAt" in df.columns:
-            df["createdAt"] = pd.to_datetime(df["createdAt"], errors="coerce", utc=True)
-
-        cols = ["author/profilePicture","text","createdAt","author/userName","author/followers",
-                "url","likeCount","replyCount","retweetCount","quoteCount","bookmarkCount","viewCount","id"]
-        df = _ensure_cols(df, cols)
-        df["tipo"] = "quote"
-        return df
+        return scraper(tweet_id, token), None
     except Exception as e:
-        st.error(f"Error al obtener citas: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), str(e)
 
 # ===================== IA =====================
+# Igual que el cliente de Apify: un modelo por API key, reutilizado entre reruns
+@st.cache_resource(show_spinner=False)
+def get_gemini_model(api_key: str):
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel("gemini-2.0-flash")
+
 def build_gemini_model(api_key: str | None):
     if not api_key or genai is None:
         return None
     try:
-        genai.configure(api_key=api_key)
-        return genai.GenerativeModel("gemini-2.0-flash")
+        return get_gemini_model(api_key)
     except Exception as e:
         st.warning(f"No se pudo inicializar Gemini: {e}")
         return None
 
-def clasificar_tweet(model, texto: str, contexto: str) -> str:
-    if not model or not isinstance(texto, str) or not texto.strip():
-        return "NEUTRO"
-    prompt = (
+# Cuota de Gemini (pedidos y tokens por minuto); ajustable por env según el plan
+def _env_int_positivo(env_key: str, default: int) -> int:
+    """Entero >= 1 desde env; un valor inválido usa el default (0 dividiría en el limitador)."""
+    try:
+        return max(1, int(os.getenv(env_key, default)))
+    except ValueError:
+        return default
+
+GEMINI_RPM = _env_int_positivo("GEMINI_RPM", 60)
+GEMINI_TPM = _env_int_positivo("GEMINI_TPM", 1000000)
+GEMINI_MAX_REINTENTOS = 3
+
+class _TokenBucket:
+    """Limitador RPM + TPM compartido entre hilos: espera en lugar de fallar por cuota."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm, self.tpm = float(rpm), float(tpm)
+        self._pedidos, self._tokens = self.rpm, self.tpm
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        dt, self._ultimo = ahora - self._ultimo, ahora
+        self._pedidos = min(self.rpm, self._pedidos + dt * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + dt * self.tpm / 60)
+
+    def acquire(self, tokens: int = 0):
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._recargar()
+                if self._pedidos >= 1 and self._tokens >= tokens:
+                    self._pedidos -= 1
+                    self._tokens -= tokens
+                    return
+                espera = max((1 - self._pedidos) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm)
+            time.sleep(espera)
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_limiter() -> _TokenBucket:
+    return _TokenBucket(GEMINI_RPM, GEMINI_TPM)
+
+def _generar(model, prompt: str, temperature: float):
+    """generate_content bajo el limitador, con reintentos ante 429 (ResourceExhausted)."""
+    limiter = get_gemini_limiter()
+    for intento in range(GEMINI_MAX_REINTENTOS + 1):
+        limiter.acquire(len(prompt) // 4)
+        try:
+            return model.generate_content(prompt, generation_config={"temperature": temperature})
+        except Exception as e:
+            if getattr(e, "code", None) != 429 or intento == GEMINI_MAX_REINTENTOS:
+                raise
+            time.sleep(2 ** intento)
+
+SENTIMIENTOS = ["POSITIVO", "NEGATIVO", "NEUTRO"]
+SENTIMIENTO_BATCH = 32
+SENTIMIENTO_WORKERS = 4
+
+_SENTIMIENTO_LINEA_RX = re.compile(r"^\s*(\d+)\s*[.):\-]\s*(POSITIVO|NEGATIVO|NEUTRO)", re.I | re.M)
+
+def _normalizar_sentimiento(linea: str) -> str:
+    linea = (linea or "").upper()
+    return next((s for s in SENTIMIENTOS if s in linea), "NEUTRO")
+
+def _parsear_etiquetas(texto: str, n: int) -> list[str]:
+    """Etiquetas por número de tweet ("3. NEGATIVO"); si no vienen numeradas, por posición."""
+    etiquetas = ["NEUTRO"] * n
+    numeradas = _SENTIMIENTO_LINEA_RX.findall(texto)
+    if numeradas:
+        for num, etiqueta in numeradas:
+            i = int(num) - 1
+            if 0 <= i < n:
+                etiquetas[i] = etiqueta.upper()
+        return etiquetas
+    lineas = [l for l in texto.splitlines() if l.strip()]
+    for i, l in enumerate(lineas[:n]):
+        etiquetas[i] = _normalizar_sentimiento(l)
+    return etiquetas
+
+def _prefijo_sentimiento(contexto: str) -> str:
+    """Parte fija del prompt (igual para todos los lotes de un mismo contexto)."""
+    return (
         f"CONTEXTO: {contexto}\n"
-        "Clasifica el sentimiento del siguiente tweet en POSITIVO, NEGATIVO o NEUTRO.\n"
-        "Responde únicamente con POSITIVO, NEGATIVO o NEUTRO.\n"
-        f'Tweet: "{texto}"\nSentimiento:'
+        "Clasifica el sentimiento de cada uno de los siguientes tweets en POSITIVO, NEGATIVO o NEUTRO.\n"
+        "Usa el formato '<número>. <ETIQUETA>' donde ETIQUETA es únicamente POSITIVO, NEGATIVO o NEUTRO.\n"
     )
+
+# Resultados de IA cacheados por contenido: el modelo va con "_" para que Streamlit no lo hashee.
+# Los errores se propagan desde la función cacheada para no guardar respuestas fallidas.
+@st.cache_data(ttl=3600, max_entries=10000, show_spinner=False)
+def _clasificar_lote_cached(_model, textos: tuple[str, ...], contexto: str) -> list[str]:
+    n = len(textos)
+    # Un tweet por línea: los saltos internos romperían la numeración
+    numerados = "\n".join(f"{i}. {' '.join(str(t).split())}" for i, t in enumerate(textos, 1))
+    prompt = (
+        f"{_prefijo_sentimiento(contexto)}"
+        f"Responde exactamente {n} líneas, una por tweet.\n"
+        f"Tweets:\n{numerados}\nSentimientos:"
+    )
+    resp = _generar(_model, prompt, 0.2)
+    return _parsear_etiquetas(resp.text or "", n)
+
+def clasificar_tweets_batch(model, textos: list[str], contexto: str) -> list[str | None]:
+    """Clasifica un lote de tweets con una sola llamada; devuelve una etiqueta por tweet (None si falló)."""
+    n = len(textos)
+    if not model or not n:
+        return ["NEUTRO"] * n
     try:
-        resp = model.generate_content(prompt, generation_config={"temperature": 0.2})
-        return (resp.text or "").strip().upper()[:8] or "NEUTRO"
+        return _clasificar_lote_cached(model, tuple(textos), contexto)
     except Exception:
-        return "NEUTRO"
+        # Sin clasificar, no NEUTRO: un lote fallido no debe sesgar la distribución
+        return [None] * n
+
+TEMAS_MAX_TWEETS = 500
+
+# La clave es un hash corto del corpus: Streamlit no re-hashea los 500 textos en cada llamada
+@st.cache_data(ttl=3600, max_entries=100, show_spinner=False)
+def _extraer_temas_cached(_model, corpus_hash: str, _texto_join: str, sentimiento: str, contexto: str, num_temas: int) -> str:
+    prompt = f"""CONTEXTO: {contexto}
+Aquí hay tweets clasificados como {sentimiento}. Extrae {num_temas} temas principales. 
+Tweets:
+{_texto_join}"""
+    resp = _generar(_model, prompt, 0.4)
+    return (resp.text or "").strip()
+
+def _textos_para_temas(df: pd.DataFrame) -> list[str]:
+    """Hasta TEMAS_MAX_TWEETS textos distintos (normalizando mayúsculas y espacios)."""
+    if "text" not in df.columns:
+        return []
+    textos = df["text"].dropna()
+    clave = textos.str.strip().str.lower().str.replace(r"\s+", " ", regex=True)
+    # Sin textos en blanco; solo los primeros TEMAS_MAX_TWEETS: no se materializa la lista completa
+    return textos[clave.ne("") & ~clave.duplicated()].head(TEMAS_MAX_TWEETS).tolist()
 
 def extraer_temas_con_ia(model, textos: list[str], sentimiento: str, contexto: str, num_temas: int = 5) -> str:
     if not model:
         return "El modelo de IA no está disponible."
-    textos = [t for t in textos if isinstance(t, str) and t.strip()]
     if not textos:
         return "No hay tweets suficientes."
-    texto_join = "\n".join(textos[:500])
-    prompt = f"""CONTEXTO: {contexto}
-Aquí hay tweets clasificados como {sentimiento}. Extrae {num_temas} temas principales. 
-Tweets:
-{texto_join}"""
+    texto_join = "\n".join(textos[:TEMAS_MAX_TWEETS])
+    corpus_hash = hashlib.sha1(texto_join.encode("utf-8")).hexdigest()
     try:
-        resp = model.generate_content(prompt, generation_config={"temperature": 0.4})
-        return (resp.text or "").strip()
+        return _extraer_temas_cached(model, corpus_hash, texto_join, sentimiento, contexto, num_temas)
     except Exception as e:
         return f"No se pudieron extraer temas. Error: {e}"
 
+def _compactar(df: pd.DataFrame) -> pd.DataFrame:
+    """Reduce la memoria del frame combinado antes de guardarlo en la sesión."""
+    # concat de categorías distintas vuelve a object: se re-categoriza sobre el total
+    for c in ("author/userName", "tipo"):
+        if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype("category")
+    # Conteos no negativos: el entero sin signo más chico que alcance
+    for c in NUM_COLS:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], downcast="unsigned")
+    return df
+
+def _calcular_totales(df_all: pd.DataFrame) -> tuple[int, int]:
+    """Alcance (vistas) e interacciones totales del conjunto descargado."""
+    # Las columnas ya vienen numéricas (y sin NaN) desde los scrapers: reducción directa
+    total_views = int(df_all["viewCount"].sum()) if "viewCount" in df_all.columns else 0
+
+    inter_cols = [c for c in ["likeCount","replyCount","retweetCount","quoteCount","bookmarkCount"] if c in df_all.columns]
+    total_interacciones = int(df_all[inter_cols].to_numpy(dtype="int64").sum()) if inter_cols else 0
+    return total_views, total_interacciones
+
+# ===================== Tablas derivadas (cacheadas por contenido del DataFrame) =====================
+@st.cache_data(ttl=3600, max_entries=100, show_spinner=False)
+def _compute_top10_views(df: pd.DataFrame) -> pd.DataFrame:
+    if "viewCount" not in df.columns:
+        return pd.DataFrame()
+    # viewCount llega sin NaN (fillna(0) en los scrapers) y nlargest ya los ignora: sin dropna previo
+    top_10 = df.nlargest(10, "viewCount")
+    return _ensure_cols(top_10, TOP10_COLS)
+
+@st.cache_data(ttl=3600, max_entries=100, show_spinner=False)
+def _compute_top_users(df: pd.DataFrame) -> pd.DataFrame:
+    if not {"author/followers","author/userName"}.issubset(df.columns):
+        return pd.DataFrame()
+    df_users = df.dropna(subset=["author/followers", "author/userName"])
+    return (
+        df_users[[c for c in ["author/userName","author/followers","author/profilePicture"] if c in df_users.columns]]
+        .sort_values("author/followers", ascending=False)
+        .drop_duplicates("author/userName", keep="first")
+        .head(10)
+    )
+
+@st.cache_data(ttl=3600, max_entries=100, show_spinner=False)
+def _compute_sentiment_counts(df: pd.DataFrame) -> pd.DataFrame:
+    if "sentimiento" not in df.columns or df["sentimiento"].dropna().empty:
+        return pd.DataFrame()
+    sent = df["sentimiento"]
+    if not isinstance(sent.dtype, pd.CategoricalDtype):
+        sent = sent.astype(pd.CategoricalDtype(SENTIMIENTOS))
+    # Pocas categorías fijas: bincount sobre los códigos, sin hashing
+    codes = sent.cat.codes.to_numpy()
+    cats = sent.cat.categories
+    counts = pd.DataFrame({
+        "Sentimiento": cats,
+        "Cantidad": np.bincount(codes[codes >= 0], minlength=len(cats)),
+    })
+    counts = counts[counts["Cantidad"] > 0].reset_index(drop=True)
+    counts["Porcentaje"] = counts["Cantidad"] / counts["Cantidad"].sum() * 100
+    return counts
+
+@st.cache_data(ttl=3600, max_entries=100, show_spinner=False)
+def _compute_timeline(df: pd.DataFrame) -> tuple[pd.DataFrame, str | None]:
+    """Cantidad de tweets por hora/día/mes según el rango de fechas."""
+    if "createdAt" not in df.columns:
+        return pd.DataFrame(), None
+    ts = df["createdAt"]
+    if not pd.api.types.is_datetime64_any_dtype(ts):
+        ts = pd.to_datetime(ts, errors="coerce", utc=True)
+    ts = ts[ts.notna()]
+    if ts.empty:
+        return pd.DataFrame(), None
+    date_range_days = (ts.max().date() - ts.min().date()).days
+    if date_range_days <= 3:
+        freq, xaxis_label = "h", "Hora"
+    elif date_range_days <= 150:
+        freq, xaxis_label = "D", "Fecha"
+    else:
+        freq, xaxis_label = "MS", "Mes"
+    # resample sobre un DatetimeIndex: agrupa en datetime64 nativo (y deja en 0 los huecos)
+    timeline = (
+        pd.Series(1, index=pd.DatetimeIndex(ts)).resample(freq).size()
+        .rename_axis("time_bucket").reset_index(name="Cantidad de Tweets")
+    )
+    return timeline, xaxis_label
+
 # ===================== App =====================
+SESSION_DEFAULTS = {
+    "tweet_id": None,
+    "df_replies_preview": pd.DataFrame(),
+    "df_quotes_preview": pd.DataFrame(),
+    "df_all": pd.DataFrame(),
+    "total_views": 0,
+    "total_interacciones": 0,
+    "data_loaded": False,
+}
+
 def main_app():
     st.image("https://publicalab.com/assets/imgs/logo-publica-blanco.svg", width=200)
     st.markdown("<h1 class='big-title'> Análisis de Respuestas y Citas - X </h1>", unsafe_allow_html=True)
@@ -201,14 +579,9 @@ def main_app():
         ejecutar = st.button("🚀 Ejecutar")
 
     # Estado persistente
-    for k, v in [
-        ("tweet_id", None),
-        ("df_replies", pd.DataFrame()),
-        ("df_quotes", pd.DataFrame()),
-        ("data_loaded", False),
-    ]:
-        if k not in st.session_state:
-            st.session_state[k] = v
+    ss = st.session_state
+    for k, v in SESSION_DEFAULTS.items():
+        ss.setdefault(k, v)
 
     parsed_id = extract_tweet_id_from_url(url_input) if url_input else None
 
@@ -217,44 +590,38 @@ def main_app():
         if not parsed_id:
             st.error("No pude extraer un ID válido de esa URL. Debe tener /status/<número>.")
             st.stop()
-        st.session_state["tweet_id"] = parsed_id
+        ss["tweet_id"] = parsed_id
 
         st.subheader("📥 Descargando datos de X/Twitter…")
-        df_replies = get_replies(parsed_id, apify_token)
-        df_quotes  = get_quotes(parsed_id, apify_token)
-
-        # Limpieza básica (excluir original si aparece y duplicados por URL)
-        if "id" in df_replies.columns:
-            df_replies = df_replies[df_replies["id"].astype(str) != str(parsed_id)]
-        if "id" in df_quotes.columns:
-            df_quotes  = df_quotes[df_quotes["id"].astype(str) != str(parsed_id)]
-        if "url" in df_replies.columns:
-            df_replies = df_replies.drop_duplicates(subset=["url"]).reset_index(drop=True)
-        if "url" in df_quotes.columns:
-            df_quotes  = df_quotes.drop_duplicates(subset=["url"]).reset_index(drop=True)
-
-        st.session_state["df_replies"] = df_replies
-        st.session_state["df_quotes"]  = df_quotes
-        st.session_state["data_loaded"] = True
+        # Replies y citas son independientes: en paralelo (los hilos heredan el contexto de Streamlit).
+        # El cliente se crea antes en el hilo principal para que ambos hilos compartan el mismo recurso.
+        get_apify_client(apify_token)
+        with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as ex:
+            f_r = ex.submit(_descargar, get_replies, parsed_id, apify_token)
+            f_q = ex.submit(_descargar, get_quotes, parsed_id, apify_token)
+            (df_replies, err_r), (df_quotes, err_q) = f_r.result(), f_q.result()
+        if err_r:
+            st.error(f"Error al obtener respuestas: {err_r}")
+        if err_q:
+            st.error(f"Error al obtener citas: {err_q}")
+
+        # Vista previa liviana: solo lo que muestra el data_editor
+        ss["df_replies_preview"] = _ensure_cols(df_replies.iloc[:5], PREVIEW_COLS).reset_index(drop=True)
+        ss["df_quotes_preview"]  = _ensure_cols(df_quotes.iloc[:5], PREVIEW_COLS).reset_index(drop=True)
+        frames = [d for d in (df_replies, df_quotes) if not d.empty]
+        ss["df_all"] = _compactar(pd.concat(frames, ignore_index=True)) if frames else pd.DataFrame()
+        # Totales fijos para este conjunto: se calculan una vez, no en cada rerun
+        ss["total_views"], ss["total_interacciones"] = _calcular_totales(ss["df_all"])
+        ss["data_loaded"] = True
 
         st.success(f"✅ {len(df_replies)} respuestas y {len(df_quotes)} citas descargadas.")
 
     # ---------- Mostrar datos si están cargados ----------
-    if st.session_state["data_loaded"]:
-        df_replies = st.session_state["df_replies"]
-        df_quotes  = st.session_state["df_quotes"]
-        df_all = pd.concat([df_replies, df_quotes], ignore_index=True)
-
-        # Métricas de alcance e interacciones
-        candidate_view_cols = ["viewCount", "views", "impressions", "impression_count", "public_metrics.impression_count"]
-        views_col = next((c for c in candidate_view_cols if c in df_all.columns), None)
-        total_views = pd.to_numeric(df_all[views_col], errors="coerce").fillna(0).sum() if views_col else 0
-
-        inter_cols = [c for c in ["likeCount","replyCount","retweetCount","quoteCount","bookmarkCount"] if c in df_all.columns]
-        total_interacciones = (
-            df_all[inter_cols].apply(pd.to_numeric, errors="coerce").fillna(0).sum().sum()
-            if inter_cols else 0
-        )
+    if ss["data_loaded"]:
+        df_all = ss["df_all"]
+
+        total_views = ss["total_views"]
+        total_interacciones = ss["total_interacciones"]
 
         st.markdown(f"""
         <div style="text-align: center; padding: 12px 0;">
@@ -268,29 +635,21 @@ def main_app():
         """, unsafe_allow_html=True)
 
         # Previews (con fotos de perfil)
-        if not df_replies.empty:
+        df_replies_preview = ss["df_replies_preview"]
+        if not df_replies_preview.empty:
             st.write("### Algunas Respuestas")
             st.data_editor(
-                df_replies.head(5),
-                column_config={
-                    "author/profilePicture": st.column_config.ImageColumn("Foto"),
-                    "url": st.column_config.LinkColumn("Tweet"),
-                    "author/userName": st.column_config.TextColumn("Usuario"),
-                    "text": st.column_config.TextColumn("Contenido"),
-                },
+                df_replies_preview,
+                column_config=PREVIEW_COLUMN_CONFIG,
                 hide_index=True,
                 use_container_width=True
             )
-        if not df_quotes.empty:
+        df_quotes_preview = ss["df_quotes_preview"]
+        if not df_quotes_preview.empty:
             st.write("### Algunas Citas")
             st.data_editor(
-                df_quotes.head(5),
-                column_config={
-                    "author/profilePicture": st.column_config.ImageColumn("Foto"),
-                    "url": st.column_config.LinkColumn("Tweet"),
-                    "author/userName": st.column_config.TextColumn("Usuario"),
-                    "text": st.column_config.TextColumn("Contenido"),
-                },
+                df_quotes_preview,
+                column_config=PREVIEW_COLUMN_CONFIG,
                 hide_index=True,
                 use_container_width=True
             )
@@ -302,64 +661,57 @@ def main_app():
             if not model:
                 st.error("Configura `GEMINI_API_KEY` (env/secrets) para usar IA.")
             else:
-                df_todos = df_all.copy()
-                if df_todos.empty:
+                if df_all.empty:
                     st.warning("No hay tweets para analizar.")
                 else:
                     # Temas principales
                     with st.spinner("Extrayendo temas principales…"):
-                        textos_todos = df_todos["text"].dropna().astype(str).tolist() if "text" in df_todos.columns else []
+                        textos_todos = _textos_para_temas(df_all)
                         resultados = extraer_temas_con_ia(model, textos_todos, "mixto", contexto, num_temas=5)
                         st.markdown("### Temas principales detectados")
                         st.write(resultados)
 
-                    # Clasificación de sentimientos (paralela)
-                    from concurrent.futures import ThreadPoolExecutor, as_completed
-                    resultados_sent = ["NEUTRO"] * len(df_todos)
-                    validos = [(i, t) for i, t in enumerate(df_todos.get("text", pd.Series([], dtype=str))) if pd.notna(t) and str(t).strip()]
-                    if validos:
+                    # Clasificación de sentimientos (por lotes, en paralelo, una vez por texto distinto)
+                    resultados_sent = np.full(len(df_all), "NEUTRO", dtype=object)
+                    textos = df_all.get("text", pd.Series([], dtype="string[pyarrow]")).fillna("")
+                    idxs = np.flatnonzero(textos.str.strip().str.len().gt(0).to_numpy())
+                    # Textos distintos + índice inverso para devolver cada etiqueta a todas sus filas
+                    # (factorize hashea en lugar de ordenar y no arma un array <U de ancho fijo)
+                    inverse, unicos = pd.factorize(textos.iloc[idxs])
+                    if len(unicos):
                         progress = st.progress(0)
-                        total = len(validos)
-                        with ThreadPoolExecutor(max_workers=5) as executor:
-                            futures = {executor.submit(clasificar_tweet, model, t, contexto): i for i, t in validos}
-                            for done, f in enumerate(as_completed(futures), 1):
-                                idx = futures[f]
-                                try:
-                                    resultados_sent[idx] = f.result() or "NEUTRO"
-                                except Exception:
-                                    resultados_sent[idx] = "NEUTRO"
-                                progress.progress(done/total)
-                        st.success("✅ Clasificación completada.")
-                        df_todos["sentimiento"] = resultados_sent
+                        unicos = list(unicos)
+                        lotes = [unicos[i:i + SENTIMIENTO_BATCH] for i in range(0, len(unicos), SENTIMIENTO_BATCH)]
+                        total = len(lotes)
+                        paso = max(1, total // 50)  # a lo sumo ~50 mensajes de progreso al navegador
+                        etiquetas_unicas = []
+                        with ThreadPoolExecutor(max_workers=SENTIMIENTO_WORKERS, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+                            resultados = executor.map(lambda lote: clasificar_tweets_batch(model, lote, contexto), lotes)
+                            for done, etiquetas in enumerate(resultados, 1):
+                                etiquetas_unicas.extend(etiquetas)
+                                if done % paso == 0 or done == total:
+                                    progress.progress(done/total)
+                        resultados_sent[idxs] = np.asarray(etiquetas_unicas, dtype=object)[inverse]
+                        sin_clasificar = int(pd.isna(resultados_sent).sum())
+                        if sin_clasificar:
+                            st.warning(f"⚠️ {sin_clasificar:,} tweets no se pudieron clasificar (error de Gemini); no se cuentan en la distribución.")
+                        else:
+                            st.success("✅ Clasificación completada.")
+                        # Copia superficial: la columna nueva no debe quedar en el df_all de la sesión
+                        df_all = df_all.copy(deep=False)
+                        df_all["sentimiento"] = pd.Categorical(resultados_sent, categories=SENTIMIENTOS)
 
                     # Top 10 por vistas
                     st.markdown("---")
                     st.subheader("🔥 Top 10 Tweets Más Vistos")
-                    if "viewCount" in df_todos.columns:
-                        df_views = df_todos.dropna(subset=["viewCount"])
-                        if not df_views.empty:
-                            top_10 = df_views.sort_values("viewCount", ascending=False).head(10).copy()
-                            top_10["viewCount"] = top_10["viewCount"].astype(int)
+                    if "viewCount" in df_all.columns:
+                        top_10 = _compute_top10_views(df_all)
+                        if not top_10.empty:
                             st.dataframe(
                                 top_10,
                                 use_container_width=True,
                                 hide_index=True,
-                                column_config={
-                                    "author/profilePicture": st.column_config.ImageColumn("Foto"),
-                                    "url": st.column_config.LinkColumn("URL"),
-                                    "viewCount": st.column_config.NumberColumn("Vistas", format="%d"),
-                                    "createdAt": st.column_config.DatetimeColumn("Fecha"),
-                                    "author/userName": st.column_config.TextColumn("Usuario"),
-                                    "author/followers": st.column_config.NumberColumn("Seguidores", format="%d"),
-                                    "likeCount": st.column_config.NumberColumn("Likes", format="%d"),
-                                    "replyCount": st.column_config.NumberColumn("Respuestas", format="%d"),
-                                    "retweetCount": st.column_config.NumberColumn("Retweets", format="%d"),
-                                    "quoteCount": st.column_config.NumberColumn("Citas", format="%d"),
-                                    "bookmarkCount": st.column_config.NumberColumn("Guardados", format="%d"),
-                                    "text": st.column_config.TextColumn("Contenido"),
-                                    "sentimiento": st.column_config.TextColumn("Sentimiento"),
-                                    "tipo": st.column_config.TextColumn("Tipo"),
-                                },
+                                column_config=TOP10_COLUMN_CONFIG,
                             )
                     else:
                         st.info("No se encontró la columna `viewCount`.")
@@ -367,36 +719,19 @@ def main_app():
                     # Top 10 usuarios por seguidores
                     st.markdown("---")
                     st.subheader("👑 Top 10 Usuarios con Más Seguidores")
-                    if {"author/followers","author/userName"}.issubset(df_todos.columns):
-                        df_users = df_todos.dropna(subset=["author/followers", "author/userName"])
-                        if not df_users.empty:
-                            top_users = (
-                                df_users.groupby("author/userName")
-                                .agg(**{
-                                    "author/followers": pd.NamedAgg(column="author/followers", aggfunc="max"),
-                                    "author/profilePicture": pd.NamedAgg(column="author/profilePicture", aggfunc="first"),
-                                })
-                                .reset_index()
-                                .sort_values("author/followers", ascending=False)
-                                .head(10)
-                            )
-                            st.dataframe(
-                                top_users,
-                                use_container_width=True,
-                                hide_index=True,
-                                column_config={
-                                    "author/profilePicture": st.column_config.ImageColumn("Foto"),
-                                    "author/userName": st.column_config.TextColumn("Usuario"),
-                                    "author/followers": st.column_config.NumberColumn("Seguidores", format="%d"),
-                                },
-                            )
+                    top_users = _compute_top_users(df_all)
+                    if not top_users.empty:
+                        st.dataframe(
+                            top_users,
+                            use_container_width=True,
+                            hide_index=True,
+                            column_config=TOP_USERS_COLUMN_CONFIG,
+                        )
 
                     # Distribución de sentimientos
                     st.subheader("📊 Distribución de Sentimientos")
-                    if "sentimiento" in df_todos.columns and not df_todos["sentimiento"].dropna().empty:
-                        counts = df_todos["sentimiento"].value_counts().reset_index()
-                        counts.columns = ["Sentimiento","Cantidad"]
-                        counts["Porcentaje"] = counts["Cantidad"] / counts["Cantidad"].sum() * 100
+                    counts = _compute_sentiment_counts(df_all)
+                    if not counts.empty:
                         st.dataframe(
                             counts.assign(Porcentaje=counts["Porcentaje"].round(2)),
                             hide_index=True,
@@ -409,31 +744,14 @@ def main_app():
                         st.info("Aún no hay sentimientos clasificados.")
 
                     # Evolución temporal
-                    if "createdAt" in df_todos.columns:
-                        df_time = df_todos.copy()
-                        df_time["createdAt"] = pd.to_datetime(df_time["createdAt"], errors="coerce", utc=True)
-                        df_time = df_time.dropna(subset=["createdAt"])
-                        if not df_time.empty:
-                            min_date = df_time["createdAt"].min().date()
-                            max_date = df_time["createdAt"].max().date()
-                            date_range_days = (max_date - min_date).days
-                            if date_range_days <= 3:
-                                df_time["time_bucket"] = df_time["createdAt"].dt.strftime("%Y-%m-%d %H:00")
-                                xaxis_label = "Hora"
-                            elif date_range_days <= 150:
-                                df_time["time_bucket"] = df_time["createdAt"].dt.date
-                                xaxis_label = "Fecha"
-                            else:
-                                df_time["time_bucket"] = df_time["createdAt"].dt.to_period("M").astype(str)
-                                xaxis_label = "Mes"
-
-                            st.markdown("---")
-                            st.subheader("📈 Evolución de Tweets en el Tiempo")
-                            timeline = df_time.groupby("time_bucket").size().reset_index(name="Cantidad de Tweets")
-                            fig_tl = px.line(timeline, x="time_bucket", y="Cantidad de Tweets",
-                                             title=f"Cantidad de Tweets por {xaxis_label}", markers=True)
-                            fig_tl.update_layout(xaxis_title=xaxis_label, yaxis_title="Número de Tweets")
-                            st.plotly_chart(fig_tl, use_container_width=True)
+                    timeline, xaxis_label = _compute_timeline(df_all)
+                    if not timeline.empty:
+                        st.markdown("---")
+                        st.subheader("📈 Evolución de Tweets en el Tiempo")
+                        fig_tl = px.line(timeline, x="time_bucket", y="Cantidad de Tweets",
+                                         title=f"Cantidad de Tweets por {xaxis_label}", markers=True)
+                        fig_tl.update_layout(xaxis_title=xaxis_label, yaxis_title="Número de Tweets")
+                        st.plotly_chart(fig_tl, use_container_width=True)
 
 
 
@@ -442,10 +760,7 @@ def main_app():
             st.info("Pegá la URL y apretá **🚀 Ejecutar** para descargar los datos.")
 
 # ---------- Entrada ----------
-if "logged_in" not in st.session_state:
-    st.session_state["logged_in"] = True
-
-if st.session_state["logged_in"]:
+if st.session_state.setdefault("logged_in", True):
     main_app()
 
 